@@ -1,14 +1,20 @@
 # angela_server.py
 import os
 import json
+import time
+import asyncio
 import csv
 import hashlib
 import hmac
 import base64
 import datetime
+import gzip
 import logging
+import re
 import tempfile
-from typing import Optional, List, Dict, Any
+import threading
+from collections import OrderedDict, deque
+from typing import Optional, List, Dict, Any, Tuple
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -16,6 +22,7 @@ from fastapi.middleware.cors import CORSMiddleware
 import requests
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
+from google.api_core import exceptions as gexc
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("angela_server")
@@ -307,8 +314,632 @@ def _already_notified(db, key: str, window_secs: int) -> bool:
     now = datetime.datetime.utcnow()
     return (now - ts) < datetime.timedelta(seconds=window_secs)
 
-def _mark_notified(db, key: str):
-    db.collection("Notifications").document(key).set({"ts": datetime.datetime.utcnow()})
+# ----------------------------- Índice de clientes
+CLIENTES_CACHE_MAX = int(os.getenv("CLIENTES_CACHE_MAX", "2048"))
+CLIENTES_CACHE_TTL_SECS = int(os.getenv("CLIENTES_CACHE_TTL_SECS", "60"))
+CLIENTES_ORDER_IDS_MAX = 50
+_clientes_cache: "OrderedDict[str, Any]" = OrderedDict()
+_clientes_cache_lock = threading.Lock()
+
+def _normalize_phone(raw: Any) -> str:
+    """
+    Deja solo dígitos y antepone el indicativo 57 a números colombianos
+    nacionales (celular 3XXXXXXXXX o fijo 60XXXXXXXX). Lo que no quede como
+    57 + 10 dígitos (p. ej. fijos de 7 dígitos sin indicativo de ciudad) se
+    descarta: dos clientes distintos podrían compartir esa clave.
+    """
+    digits = re.sub(r"\D", "", str(raw or ""))
+    if digits.startswith("00"):
+        digits = digits[2:]
+    if len(digits) == 10 and (digits.startswith("3") or digits.startswith("60")):
+        digits = "57" + digits
+    return digits if len(digits) == 12 and digits.startswith("57") else ""
+
+def _normalize_cedula(raw: Any) -> str:
+    digits = re.sub(r"\D", "", str(raw or "")).lstrip("0")
+    return digits if len(digits) >= 5 else ""
+
+def _customer_keys(customer: Dict[str, Any]) -> List[str]:
+    keys = []
+    phone = _normalize_phone(customer.get("phone"))
+    if phone:
+        keys.append(f"tel:{phone}")
+    cedula = _normalize_cedula(customer.get("cedula"))
+    if cedula:
+        keys.append(f"cc:{cedula}")
+    return keys
+
+def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    with _clientes_cache_lock:
+        hit = _clientes_cache.get(key)
+        if not hit:
+            return None
+        ts, profile = hit
+        if (datetime.datetime.utcnow() - ts).total_seconds() > CLIENTES_CACHE_TTL_SECS:
+            del _clientes_cache[key]
+            return None
+        _clientes_cache.move_to_end(key)
+        return profile
+
+def _cache_put(key: str, profile: Dict[str, Any]):
+    with _clientes_cache_lock:
+        _clientes_cache[key] = (datetime.datetime.utcnow(), profile)
+        _clientes_cache.move_to_end(key)
+        while len(_clientes_cache) > CLIENTES_CACHE_MAX:
+            _clientes_cache.popitem(last=False)
+
+def _order_entry(p: Dict[str, Any]) -> Dict[str, Any]:
+    created = p.get("created_at")
+    return {
+        "order_number": p.get("order_number"),
+        "status": p.get("status"),
+        "total": float(p.get("total") or 0.0),
+        "paid_like": bool(p.get("paid_like")),
+        "created_at": _normalize_ts(created) if isinstance(created, datetime.datetime) else None,
+    }
+
+def _order_sort_key(order_id: str, entry: Dict[str, Any]):
+    created = entry.get("created_at")
+    created = _normalize_ts(created) if isinstance(created, datetime.datetime) else datetime.datetime.min
+    return (created, int(order_id) if order_id.isdigit() else 0)
+
+def _merge_profile(key: str, profile: Dict[str, Any], previous: Dict[str, Dict[str, Any]],
+                   entries: Dict[str, Dict[str, Any]], customer: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Actualiza los agregados del perfil con `entries` ({order_id: entrada}).
+    `previous` son las entradas que ya existían en `Clientes/{key}/Pedidos`: si un
+    pedido se re-entrega se resta su versión anterior en vez de sumarlo dos veces.
+    """
+    count = int(profile.get("order_count") or 0)
+    lifetime = float(profile.get("lifetime_total") or 0.0)
+    last = profile.get("last_order")
+    for order_id, entry in entries.items():
+        old = previous.get(order_id)
+        if old is None:
+            count += 1
+        elif old.get("paid_like"):
+            lifetime -= float(old.get("total") or 0.0)
+        if entry["paid_like"]:
+            lifetime += entry["total"]
+        if not last or _order_sort_key(order_id, entry) >= _order_sort_key(str(last.get("order_id")), last):
+            last = {"order_id": order_id, **entry}
+
+    recent = set(profile.get("order_ids") or []) | set(entries)
+    return {
+        "key": key,
+        "name": customer.get("name") or profile.get("name", ""),
+        "phone": _normalize_phone(customer.get("phone")) or profile.get("phone", ""),
+        "cedula": _normalize_cedula(customer.get("cedula")) or profile.get("cedula", ""),
+        "email": customer.get("email") or profile.get("email", ""),
+        "order_count": count,
+        "lifetime_total": lifetime,
+        # solo los más recientes; el historial completo está en la subcolección
+        "order_ids": sorted(recent, key=lambda k: int(k) if k.isdigit() else 0)[-CLIENTES_ORDER_IDS_MAX:],
+        "last_order": last,
+        "updated_at": datetime.datetime.utcnow(),
+    }
+
+def _index_chunks(pedidos: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Parte los pedidos para que cada transacción quede dentro de FIRESTORE_BATCH_MAX
+    escrituras: por pedido, un perfil y una entrada por cada clave (tel/cc).
+    """
+    chunks: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    writes = 0
+    for p in pedidos:
+        if not p.get("order_id"):
+            continue
+        cost = 2 * len(_customer_keys(p.get("customer") or {}))
+        if not cost:
+            continue
+        if current and writes + cost > FIRESTORE_BATCH_MAX:
+            chunks.append(current)
+            current, writes = [], 0
+        current.append(p)
+        writes += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _index_customers(db, pedidos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Actualiza `Clientes` (una entrada por teléfono y otra por cédula), con una
+    transacción por bloque de `_index_chunks`. El perfil guarda solo agregados;
+    cada pedido va a `Clientes/{key}/Pedidos/{order_id}`. Devuelve los pedidos
+    de los bloques que fallaron.
+    """
+    failed: List[Dict[str, Any]] = []
+    for chunk in _index_chunks(pedidos):
+        try:
+            _index_customers_chunk(db, chunk)
+        except Exception as e:
+            logger.exception(f"No se pudo actualizar índice de clientes ({len(chunk)} pedidos): {e}")
+            failed.extend(chunk)
+    return failed
+
+def _index_customers_chunk(db, pedidos: List[Dict[str, Any]]):
+    touched: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    customers: Dict[str, Dict[str, Any]] = {}
+    for p in pedidos:
+        for key in _customer_keys(p.get("customer") or {}):
+            touched.setdefault(key, {})[str(p["order_id"])] = _order_entry(p)
+            customers[key] = p.get("customer") or {}
+    if not touched:
+        return
+
+    col = db.collection("Clientes")
+    refs = {key: col.document(key) for key in touched}
+    entry_refs = {
+        (key, order_id): col.document(key).collection("Pedidos").document(order_id)
+        for key, entries in touched.items() for order_id in entries
+    }
+    merged: Dict[str, Dict[str, Any]] = {}
+
+    @firestore.transactional
+    def _apply(transaction):
+        by_path = {s.reference.path: s for s in transaction.get_all(list(refs.values()) + list(entry_refs.values()))}
+        for key, ref in refs.items():
+            snap = by_path.get(ref.path)
+            current = (snap.to_dict() if snap is not None and snap.exists else None) or {}
+            previous = {}
+            for order_id in touched[key]:
+                esnap = by_path.get(entry_refs[(key, order_id)].path)
+                if esnap is not None and esnap.exists:
+                    previous[order_id] = esnap.to_dict() or {}
+            merged[key] = _merge_profile(key, current, previous, touched[key], customers[key])
+            transaction.set(ref, merged[key])
+            for order_id, entry in touched[key].items():
+                transaction.set(entry_refs[(key, order_id)], entry)
+
+    _apply(db.transaction())
+    for key, profile in merged.items():
+        _cache_put(key, profile)
+
+# ----------------------------- Retención / archivo
+ARCHIVE_DT_FIELDS = ("created_at", "ingested_at")
+ARCHIVE_STUB_FIELDS = [
+    "order_id", "order_number", "status", "currency", "total",
+    "created_at", "ingested_at", "paid_like", "whatsapp_sent", "source",
+]
+# Firestore admite 500 operaciones por batch; dejamos margen.
+FIRESTORE_BATCH_MAX = 450
+ARCHIVE_WRITE_RETRIES = 5
+# pedidos que seguían abiertos cuando la marca de agua los pasó
+ARCHIVE_OPEN_COLLECTION = "CompactacionAbiertos"
+
+def _check_admin(request: Request):
+    token = os.getenv("ANGELA_ADMIN_TOKEN", "")
+    if not token:
+        # sin token configurado no se expone nada destructivo
+        logger.warning("ADMIN: ANGELA_ADMIN_TOKEN no está configurada; se rechaza la petición.")
+        raise HTTPException(status_code=503, detail="ANGELA_ADMIN_TOKEN no configurada")
+    hdr = request.headers.get("x-admin-token", "")
+    if not (hdr and hmac.compare_digest(hdr, token)):
+        raise HTTPException(status_code=401, detail="Token de administración no válido")
+
+def _archive_month_path(month: str) -> str:
+    prefix = os.getenv("ARCHIVE_PREFIX", "archivo/pedidos").rstrip("/")
+    return f"{prefix}/{month}.ndjson.gz"
+
+def _json_default(o):
+    if isinstance(o, datetime.datetime):
+        return _normalize_ts(o).isoformat()
+    return str(o)
+
+def _parse_archive(raw: bytes) -> Dict[str, Dict[str, Any]]:
+    out: Dict[str, Dict[str, Any]] = {}
+    for line in gzip.decompress(raw).decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        rec = json.loads(line)
+        for f in ARCHIVE_DT_FIELDS:
+            if isinstance(rec.get(f), str):
+                try:
+                    rec[f] = datetime.datetime.fromisoformat(rec[f])
+                except ValueError:
+                    pass
+        out[str(rec.pop("_doc_id", rec.get("order_id")))] = rec
+    return out
+
+def _load_archive_month(bucket, month: str) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """
+    Devuelve ({doc_id: pedido completo}, generation) del mes archivado.
+    generation es 0 si el archivo no existe.
+    """
+    blob = bucket.get_blob(_archive_month_path(month))
+    if blob is None:
+        return {}, 0
+    return _parse_archive(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+
+def _read_archive_month(bucket, month: str) -> Dict[str, Dict[str, Any]]:
+    return _load_archive_month(bucket, month)[0]
+
+def _write_archive_month(bucket, month: str, docs: Dict[str, Dict[str, Any]]) -> str:
+    """
+    Fusiona `docs` con lo que ya exista para el mes y reescribe el archivo.
+    La fusión es por doc_id, así que re-ejecutar la compactación es idempotente.
+    La subida exige la misma generation que se leyó: si otra corrida escribió
+    el mes entre medio, se vuelve a leer y fusionar en vez de pisarla.
+    """
+    path = _archive_month_path(month)
+    for _ in range(ARCHIVE_WRITE_RETRIES):
+        try:
+            merged, generation = _load_archive_month(bucket, month)
+            merged.update(docs)
+            ordered = sorted(merged.items(), key=lambda kv: _json_default(kv[1].get("created_at") or ""))
+            lines = [json.dumps({"_doc_id": k, **v}, ensure_ascii=False, default=_json_default) for k, v in ordered]
+            data = gzip.compress(("\n".join(lines) + "\n").encode("utf-8"))
+            # Sin make_public: el archivo contiene datos personales de clientes.
+            bucket.blob(path).upload_from_string(data, content_type="application/gzip",
+                                                 if_generation_match=generation)
+            return path
+        except (gexc.PreconditionFailed, gexc.NotFound):
+            logger.info(f"ARCHIVO: {path} cambió mientras se escribía; se vuelve a fusionar.")
+    raise RuntimeError(f"No se pudo escribir {path}: demasiadas escrituras concurrentes")
+
+def _archive_stub(data: Dict[str, Any], path: str) -> Dict[str, Any]:
+    customer = data.get("customer") or {}
+    stub = {k: data.get(k) for k in ARCHIVE_STUB_FIELDS if k in data}
+    # los campos de customer que proyecta /pedidos
+    stub["customer"] = {"name": customer.get("name", ""), "phone": customer.get("phone")}
+    stub["archived"] = True
+    stub["archive_path"] = path
+    stub["archived_at"] = datetime.datetime.utcnow()
+    return stub
+
+def _hydrate_archived(bucket, entries: List[Any]) -> List[Any]:
+    """
+    Reemplaza los stubs archivados por el pedido completo, cargando cada mes
+    necesario una sola vez. `entries` es una lista de (doc_id, data).
+    """
+    months: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    out = []
+    for doc_id, data in entries:
+        if data.get("archived"):
+            created = data.get("created_at")
+            month = _normalize_ts(created).strftime("%Y-%m") if isinstance(created, datetime.datetime) else ""
+            if month and month not in months:
+                months[month] = _read_archive_month(bucket, month)
+            full = months.get(month, {}).get(doc_id)
+            if full:
+                data = full
+            else:
+                logger.warning(f"ARCHIVO: pedido {doc_id} marcado como archivado pero no está en {month or '?'}")
+        out.append((doc_id, data))
+    return out
+
+def _prune_notifications(db, older_than: datetime.datetime, limit: int, dry_run: bool = False) -> int:
+    """
+    Borra marcadores de dedupe (`Notifications`) más viejos que la ventana;
+    pasada la ventana `_already_notified` ya no los tiene en cuenta.
+    """
+    q = db.collection("Notifications").where("ts", "<", older_than).limit(limit)
+    deleted = 0
+    batch = db.batch()
+    pending = 0
+    for snap in q.stream():
+        deleted += 1
+        if dry_run:
+            continue
+        batch.delete(snap.reference)
+        pending += 1
+        if pending >= FIRESTORE_BATCH_MAX:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return deleted
+
+def _write_stubs(db, snaps: List[Any], path: str) -> Tuple[int, List[str]]:
+    """
+    Reemplaza cada pedido por su stub solo si no cambió desde que se leyó
+    (precondición last_update_time). Devuelve (escritos, ids omitidos); un pedido
+    omitido sigue completo en Firestore y se vuelve a revisar en otra corrida.
+    """
+    ops = []
+    for snap in snaps:
+        data = snap.to_dict() or {}
+        stub = _archive_stub(data, path)
+        fields = {**{k: firestore.DELETE_FIELD for k in data if k not in stub}, **stub}
+        ops.append((snap.reference, fields, db.write_option(last_update_time=snap.update_time)))
+
+    written = 0
+    skipped: List[str] = []
+    for i in range(0, len(ops), FIRESTORE_BATCH_MAX):
+        chunk = ops[i:i + FIRESTORE_BATCH_MAX]
+        batch = db.batch()
+        for ref, fields, option in chunk:
+            batch.update(ref, fields, option=option)
+        try:
+            batch.commit()
+            written += len(chunk)
+        except gexc.FailedPrecondition:
+            # algún pedido cambió (p. ej. llegó un webhook): uno a uno para omitir solo esos
+            for ref, fields, option in chunk:
+                try:
+                    ref.update(fields, option=option)
+                    written += 1
+                except (gexc.FailedPrecondition, gexc.NotFound):
+                    skipped.append(ref.id)
+    return written, skipped
+
+def _archive_closed_orders(db, bucket, older_than: datetime.datetime, limit: int,
+                           closed_statuses: set, full_scan: bool = False, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Mueve los `Pedidos` cerrados anteriores a `older_than` a archivos mensuales
+    en Storage y deja un stub en Firestore.
+
+    Cada corrida lee a lo sumo `limit` pedidos después de la marca de agua
+    (created_at, doc_id) guardada en `Mantenimiento/compactacion`, más hasta
+    `limit` pedidos de `CompactacionAbiertos`: los que seguían abiertos cuando la
+    marca los pasó. Así la marca siempre avanza y un pedido que nunca cierra
+    solo cuesta su propia relectura. Con `full_scan` se recorre todo desde el
+    principio.
+    """
+    col = db.collection("Pedidos")
+    track = db.collection(ARCHIVE_OPEN_COLLECTION)
+    state_ref = db.collection("Mantenimiento").document("compactacion")
+    state = (state_ref.get().to_dict() or {}) if not full_scan else {}
+
+    def _closed(data: Dict[str, Any]) -> bool:
+        return (data.get("status") or "").lower() in closed_statuses
+
+    candidates: Dict[str, Dict[str, Any]] = {}  # mes -> {doc_id: snapshot}
+
+    def _add(snap, data):
+        month = _normalize_ts(data["created_at"]).strftime("%Y-%m")
+        candidates.setdefault(month, {})[snap.id] = snap
+
+    # 1) abiertos de corridas anteriores
+    rechecked = 0
+    untrack: List[str] = []
+    still_open: List[str] = []
+    tracked = list(track.order_by("checked_at").limit(limit).stream())
+    if tracked:
+        for snap in db.get_all([col.document(t.id) for t in tracked]):
+            rechecked += 1
+            data = (snap.to_dict() if snap.exists else None) or {}
+            if not data or data.get("archived") or not isinstance(data.get("created_at"), datetime.datetime):
+                untrack.append(snap.id)
+            elif _closed(data):
+                _add(snap, data)
+            else:
+                still_open.append(snap.id)
+
+    # 2) pedidos nuevos desde la marca de agua
+    q = (col.where("created_at", "<", older_than)
+         .order_by("created_at")
+         .order_by(firestore.FieldPath.document_id()))
+    mark_ts, mark_id = state.get("pedidos_hasta"), state.get("pedidos_hasta_id")
+    if isinstance(mark_ts, datetime.datetime) and mark_id:
+        q = q.start_after({"created_at": mark_ts, "__name__": col.document(mark_id)})
+    scanned = 0
+    last = None
+    newly_open: List[Any] = []
+    for snap in q.limit(limit).stream():
+        scanned += 1
+        data = snap.to_dict() or {}
+        last = (data.get("created_at"), snap.id)
+        if data.get("archived"):
+            continue
+        if _closed(data):
+            _add(snap, data)
+        else:
+            newly_open.append((snap.id, data.get("created_at")))
+
+    archived = 0
+    skipped: List[str] = []
+    months_written: List[str] = []
+    for month, snaps in sorted(candidates.items()):
+        months_written.append(month)
+        if dry_run:
+            archived += len(snaps)
+            continue
+        path = _write_archive_month(bucket, month, {k: s.to_dict() or {} for k, s in snaps.items()})
+        # stubs solo después de que el archivo quedó escrito
+        n, month_skipped = _write_stubs(db, list(snaps.values()), path)
+        archived += n
+        skipped.extend(month_skipped)
+
+    if not dry_run:
+        now = datetime.datetime.utcnow()
+        archived_ids = {k for snaps in candidates.values() for k in snaps} - set(skipped)
+        ops = [("delete", doc_id, None) for doc_id in set(untrack) | (archived_ids & {t.id for t in tracked})]
+        ops += [("set", doc_id, {"checked_at": now}) for doc_id in still_open + skipped]
+        ops += [("set", doc_id, {"created_at": created, "checked_at": now}) for doc_id, created in newly_open]
+        for i in range(0, len(ops), FIRESTORE_BATCH_MAX):
+            batch = db.batch()
+            for kind, doc_id, data in ops[i:i + FIRESTORE_BATCH_MAX]:
+                if kind == "delete":
+                    batch.delete(track.document(doc_id))
+                else:
+                    batch.set(track.document(doc_id), data, merge=True)
+            batch.commit()
+        if last is not None:
+            state_ref.set({"pedidos_hasta": last[0], "pedidos_hasta_id": last[1], "ts": now}, merge=True)
+
+    return {
+        "scanned": scanned,
+        "rechecked": rechecked,
+        "archived": archived,
+        "skipped_changed": len(skipped),
+        "open_tracked": len(still_open) + len(newly_open),
+        "months": months_written,
+        "complete": scanned < limit,
+    }
+
+# ----------------------------- Coalescing de escrituras (ingesta)
+# Ventana en ms durante la cual se juntan las escrituras del webhook; 0 = escritura directa.
+PEDIDOS_COALESCE_MS = int(os.getenv("PEDIDOS_COALESCE_MS", "10"))
+# Cada pedido puede sumar 2 operaciones (Pedidos + Notifications) al batch.
+PEDIDOS_COALESCE_MAX = FIRESTORE_BATCH_MAX // 2
+_write_buffer: Dict[str, Dict[str, Any]] = {}
+_write_marks: set = set()
+# marcas ya sacadas del buffer cuyo batch aún no confirma
+_marks_committing: set = set()
+_flush_task: Optional["asyncio.Task"] = None
+# referencias fuertes a los flush en curso (el loop solo guarda referencias débiles)
+_flush_tasks: set = set()
+# un flush a la vez: si dos batches corrieran en paralelo, una versión vieja
+# de un pedido podría confirmarse después de la nueva y pisarla
+_flush_lock = asyncio.Lock()
+# pedidos cuyo índice de clientes falló; se reintentan en el siguiente flush
+INDEX_RETRY_MAX = 5000
+_index_retry: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_write_metrics: Dict[str, Any] = {
+    "flushes": 0,
+    "orders_written": 0,
+    "versions_coalesced": 0,
+    "marks_written": 0,
+    "flush_errors": 0,
+    "index_errors": 0,
+    "index_dropped": 0,
+    "batch_sizes": deque(maxlen=1000),
+    "flush_ms": deque(maxlen=1000),
+}
+
+def _order_modified(doc: Dict[str, Any]) -> str:
+    raw = doc.get("raw") or {}
+    return str(raw.get("date_modified_gmt") or raw.get("date_modified") or "")
+
+def _mark_pending(key: str) -> bool:
+    """
+    True si la marca de dedupe ya está encolada o en un batch en curso. El
+    webhook la consulta junto a `_already_notified` para que una re-entrega que
+    llega mientras se espera el batch no vuelva a enviar WhatsApp.
+    """
+    return key in _write_marks or key in _marks_committing
+
+def _spawn_flush(loop, coro) -> "asyncio.Task":
+    task = loop.create_task(coro)
+    _flush_tasks.add(task)
+    task.add_done_callback(_flush_tasks.discard)
+    return task
+
+def _commit_writes(db, docs: Dict[str, Dict[str, Any]], marks: set):
+    """
+    Escribe pedidos y marcas de dedupe en batches atómicos y luego actualiza el
+    índice de clientes, incluyendo los pedidos cuyo índice falló antes. Corre
+    siempre bajo `_flush_lock`, así que `_index_retry` no necesita lock propio.
+    """
+    ops = [(db.collection("Pedidos").document(k), v) for k, v in docs.items()]
+    now = datetime.datetime.utcnow()
+    ops += [(db.collection("Notifications").document(k), {"ts": now}) for k in marks]
+    for i in range(0, len(ops), FIRESTORE_BATCH_MAX):
+        batch = db.batch()
+        for ref, data in ops[i:i + FIRESTORE_BATCH_MAX]:
+            batch.set(ref, data)
+        batch.commit()
+    pending = OrderedDict(_index_retry)
+    _index_retry.clear()
+    for doc in docs.values():
+        if doc.get("order_id"):
+            pending[str(doc["order_id"])] = doc
+    if not pending:
+        return
+    failed = _index_customers(db, list(pending.values()))
+    if failed:
+        _write_metrics["index_errors"] += len(failed)
+        for doc in failed:
+            _index_retry[str(doc["order_id"])] = doc
+        while len(_index_retry) > INDEX_RETRY_MAX:
+            order_id, _ = _index_retry.popitem(last=False)
+            _write_metrics["index_dropped"] += 1
+            logger.error(f"INGESTA: índice de clientes descartado para pedido {order_id} (cola de reintento llena)")
+
+async def _flush_writes():
+    # el buffer se toma ya con el lock: lo que llega mientras otro batch
+    # confirma espera al siguiente flush
+    async with _flush_lock:
+        await _flush_buffer()
+
+async def _flush_buffer():
+    global _write_buffer, _write_marks, _flush_task
+    buf, marks = _write_buffer, _write_marks
+    _write_buffer, _write_marks, _flush_task = {}, set(), None
+    if not buf and not marks:
+        return
+
+    t0 = time.perf_counter()
+    _marks_committing.update(marks)
+    try:
+        db, _ = _db_bucket()
+        await asyncio.to_thread(_commit_writes, db, {k: v["doc"] for k, v in buf.items()}, marks)
+    except Exception as e:
+        _write_metrics["flush_errors"] += 1
+        logger.exception(f"INGESTA: falló el batch de {len(buf)} pedidos: {e}")
+        for entry in buf.values():
+            for fut in entry["futures"]:
+                if not fut.done():
+                    fut.set_exception(e)
+        return
+    finally:
+        _marks_committing.difference_update(marks)
+
+    _write_metrics["flushes"] += 1
+    _write_metrics["orders_written"] += len(buf)
+    _write_metrics["marks_written"] += len(marks)
+    _write_metrics["batch_sizes"].append(len(buf) + len(marks))
+    _write_metrics["flush_ms"].append((time.perf_counter() - t0) * 1000)
+    for entry in buf.values():
+        for fut in entry["futures"]:
+            if not fut.done():
+                fut.set_result(True)
+
+async def _flush_after(delay: float):
+    await asyncio.sleep(delay)
+    await _flush_writes()
+
+async def _write_pedido(db, doc_id: str, doc: Dict[str, Any], notify_key: Optional[str] = None):
+    """
+    Encola la escritura del pedido (y su marca de dedupe) y espera a que el batch
+    que la contiene quede confirmado. Si llegan varias versiones del mismo pedido
+    dentro de la ventana, solo se escribe la más reciente según date_modified
+    (o la última en llegar si no hay fecha).
+    """
+    global _flush_task
+    if PEDIDOS_COALESCE_MS <= 0:
+        marks = {notify_key} if notify_key else set()
+        _marks_committing.update(marks)
+        try:
+            async with _flush_lock:
+                await asyncio.to_thread(_commit_writes, db, {doc_id: doc}, marks)
+        finally:
+            _marks_committing.difference_update(marks)
+        return
+
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    entry = _write_buffer.get(doc_id)
+    if entry is None:
+        _write_buffer[doc_id] = {"doc": doc, "futures": [fut]}
+    else:
+        _write_metrics["versions_coalesced"] += 1
+        if _order_modified(doc) >= _order_modified(entry["doc"]):
+            entry["doc"] = doc
+        entry["futures"].append(fut)
+    if notify_key:
+        _write_marks.add(notify_key)
+
+    if len(_write_buffer) + len(_write_marks) >= PEDIDOS_COALESCE_MAX:
+        _spawn_flush(loop, _flush_writes())
+    elif _flush_task is None:
+        _flush_task = _spawn_flush(loop, _flush_after(PEDIDOS_COALESCE_MS / 1000))
+    await fut
+
+def _summary(values) -> Dict[str, float]:
+    vals = sorted(values)
+    if not vals:
+        return {"n": 0, "avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    return {
+        "n": len(vals),
+        "avg": round(sum(vals) / len(vals), 2),
+        "p50": round(vals[len(vals) // 2], 2),
+        "p95": round(vals[min(len(vals) - 1, int(len(vals) * 0.95))], 2),
+        "max": round(vals[-1], 2),
+    }
 
 # ----------------------------- Endpoints base
 @app.get("/")
@@ -406,7 +1037,7 @@ async def webhook_woocommerce(request: Request):
     # dedupe por (order_id + status) SOLO para estados de compra
     dd_window = int(os.getenv("WA_DEDUP_WINDOW_SECS", "900"))
     dd_key = f"wa:{order_id}:{status}"
-    if is_paid_like and _already_notified(db, dd_key, dd_window):
+    if is_paid_like and dd_window > 0 and (_mark_pending(dd_key) or _already_notified(db, dd_key, dd_window)):
         if DEBUG_WEBHOOK:
             logger.info(f"[WEBHOOK] Dedup skip {dd_key} (order_id={order_id}, status={status})")
         return {"ok": True, "dedup": True, "skipped_reason": "duplicate_paid_status"}
@@ -453,6 +1084,7 @@ async def webhook_woocommerce(request: Request):
     # --- WhatsApp & Woo updates
     updated = None
     wa_resp = None
+    notify_key = None
 
     if is_paid_like and order_id and os.getenv("WOO_UPDATE_ON_HOLD", "0") == "1":
         updated = _update_woocommerce_status(order_id, "on-hold")
@@ -467,7 +1099,7 @@ async def webhook_woocommerce(request: Request):
 
     if can_send_wa:
         wa_resp = _send_whatsapp_to_all(wa_text)
-        _mark_notified(db, dd_key)
+        notify_key = dd_key
         if is_paid_like and order_id and wa_resp:
             # marcamos el pedido en Woo con una nota interna
             note_ts = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
@@ -491,6 +1123,7 @@ async def webhook_woocommerce(request: Request):
             "name": customer_name,
             "phone": billing.get("phone"),
             "email": billing.get("email"),
+            "cedula": _extraer_cedula(payload),
             "billing": billing,
             "shipping": shipping,
         },
@@ -503,8 +1136,9 @@ async def webhook_woocommerce(request: Request):
         "paid_like": is_paid_like,
         "whatsapp_sent": whatsapp_sent,
     }
-    doc_id = str(order_id) if order_id else firestore.AUTO_ID
-    db.collection("Pedidos").document(doc_id).set(doc)
+    doc_id = str(order_id) if order_id else db.collection("Pedidos").document().id
+    # se responde solo cuando el batch con este pedido quedó confirmado en Firestore
+    await _write_pedido(db, doc_id, doc, notify_key)
 
     return {
         "ok": True,
@@ -522,17 +1156,116 @@ async def webhook_woocommerce(request: Request):
 # ----------------------------- Texto para copiar
 @app.get("/pedido/{order_number}/whatsapp_text")
 def whatsapp_text(order_number: str):
-    db, _ = _db_bucket()
+    db, bucket = _db_bucket()
     doc_ref = db.collection("Pedidos").document(order_number).get()
     if doc_ref.exists:
-        data = doc_ref.to_dict()
+        _, data = _hydrate_archived(bucket, [(doc_ref.id, doc_ref.to_dict() or {})])[0]
         return {"order_number": order_number, "text": data.get("wa_text", "")}
     docs = list(db.collection("Pedidos").where("order_number", "==", order_number).limit(1).stream())
     if docs:
-        data = docs[0].to_dict()
+        _, data = _hydrate_archived(bucket, [(docs[0].id, docs[0].to_dict() or {})])[0]
         return {"order_number": order_number, "text": data.get("wa_text", "")}
     raise HTTPException(status_code=404, detail="Pedido no encontrado")
 
+# ----------------------------- Listado de pedidos
+PEDIDOS_LIST_FIELDS = [
+    "order_id", "order_number", "status", "currency", "total", "created_at",
+    "paid_like", "whatsapp_sent", "customer.name", "customer.phone", "archived",
+]
+
+def _encode_cursor(created_at: datetime.datetime, doc_id: str) -> str:
+    raw = json.dumps({"t": created_at.isoformat(), "id": doc_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        ts, doc_id = datetime.datetime.fromisoformat(data["t"]), str(data["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    # un id con "/" haría fallar col.document() con un 500
+    if not doc_id or "/" in doc_id or doc_id in (".", ".."):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return ts, doc_id
+
+@app.get("/pedidos")
+def pedidos_listar(
+    status: Optional[str] = Query(None, description="Filtrar por estado"),
+    desde: Optional[str] = Query(None, description="Fecha inicio (YYYY-MM-DD o ISO)"),
+    hasta: Optional[str] = Query(None, description="Fecha fin (YYYY-MM-DD o ISO)"),
+    paid_like: Optional[bool] = Query(None, description="Solo pedidos de compra / no compra"),
+    whatsapp_sent: Optional[bool] = Query(None, description="Solo enviados / no enviados a WhatsApp"),
+    limite: int = Query(50, ge=1, le=200, description="Tamaño de página"),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior"),
+):
+    """
+    Lista pedidos del más nuevo al más viejo, paginando con `start_after`.
+    El cursor lleva (created_at, doc_id) del último pedido de la página, así que
+    no hace falta leer ese documento. Solo se leen los campos de
+    PEDIDOS_LIST_FIELDS (nunca `raw`); los índices compuestos están en
+    firestore.indexes.json.
+    """
+    db, _ = _db_bucket()
+    col = db.collection("Pedidos")
+    q = col
+    if status:
+        q = q.where("status", "==", status.strip().lower())
+    if paid_like is not None:
+        q = q.where("paid_like", "==", paid_like)
+    if whatsapp_sent is not None:
+        q = q.where("whatsapp_sent", "==", whatsapp_sent)
+    if desde:
+        q = q.where("created_at", ">=", _parse_iso_date(desde))
+    if hasta:
+        q = q.where("created_at", "<=", _parse_iso_date(hasta, end_of_day=True))
+    q = (q.order_by("created_at", direction=firestore.Query.DESCENDING)
+         .order_by(firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+         .select(PEDIDOS_LIST_FIELDS))
+
+    if cursor:
+        cursor_ts, cursor_id = _decode_cursor(cursor)
+        q = q.start_after({"created_at": cursor_ts, "__name__": col.document(cursor_id)})
+
+    # uno extra para saber si hay otra página sin contar toda la colección
+    docs = list(q.limit(limite + 1).stream())
+    page = docs[:limite]
+    items = [{"id": d.id, **(d.to_dict() or {})} for d in page]
+    next_cursor = None
+    if len(docs) > limite and isinstance(items[-1].get("created_at"), datetime.datetime):
+        next_cursor = _encode_cursor(items[-1]["created_at"], items[-1]["id"])
+    return {
+        "items": items,
+        "next_cursor": next_cursor,
+        "limite": limite,
+    }
+
+# ----------------------------- Clientes
+@app.get("/clientes/buscar")
+def clientes_buscar(
+    telefono: Optional[str] = Query(None, description="Teléfono (con o sin +57, espacios o guiones)"),
+    cedula: Optional[str] = Query(None, description="Cédula / documento"),
+):
+    if telefono:
+        phone = _normalize_phone(telefono)
+        key = f"tel:{phone}" if phone else ""
+    elif cedula:
+        cc = _normalize_cedula(cedula)
+        key = f"cc:{cc}" if cc else ""
+    else:
+        raise HTTPException(status_code=400, detail="Indica telefono o cedula")
+    if not key:
+        raise HTTPException(status_code=400, detail="Identificador inválido")
+
+    profile = _cache_get(key)
+    if profile is None:
+        db, _ = _db_bucket()
+        snap = db.collection("Clientes").document(key).get()
+        if not snap.exists:
+            raise HTTPException(status_code=404, detail="Cliente no encontrado")
+        profile = snap.to_dict() or {}
+        _cache_put(key, profile)
+    return profile
+
 # ----------------------------- Reporte CSV
 @app.get("/reportes/ventas")
 def reportes_ventas(
@@ -540,7 +1273,7 @@ def reportes_ventas(
     hasta: str = Query(..., description="Fecha fin (YYYY-MM-DD o ISO)"),
     status: Optional[str] = Query(None, description="Filtrar por estado (opcional)"),
 ):
-    db, _ = _db_bucket()
+    db, bucket = _db_bucket()
     start_dt = _parse_iso_date(desde)
     end_dt = _parse_iso_date(hasta, end_of_day=True)
 
@@ -548,14 +1281,14 @@ def reportes_ventas(
     if status:
         q = q.where("status", "==", status)
 
-    docs = list(q.stream())
+    # los pedidos archivados vuelven como stub; se completan desde Storage
+    docs = _hydrate_archived(bucket, [(d.id, d.to_dict() or {}) for d in q.stream()])
     total_orders = len(docs)
     total_amount = 0.0
     prod_count: Dict[str, int] = {}
     rows: List[List[Any]] = [["order_number", "fecha", "cliente", "estado", "total", "items"]]
 
-    for d in docs:
-        data = d.to_dict()
+    for _, data in docs:
         total = float(data.get("total") or 0.0)
         total_amount += total
         items = data.get("items") or []
@@ -595,3 +1328,61 @@ def reportes_ventas(
         "csv_url": url
     }
 
+
+
+# ----------------------------- Métricas
+@app.get("/metricas/ingesta")
+def metricas_ingesta():
+    m = _write_metrics
+    return {
+        "coalesce_ms": PEDIDOS_COALESCE_MS,
+        "flushes": m["flushes"],
+        "orders_written": m["orders_written"],
+        "versions_coalesced": m["versions_coalesced"],
+        "marks_written": m["marks_written"],
+        "flush_errors": m["flush_errors"],
+        "index_errors": m["index_errors"],
+        "index_retry_pending": len(_index_retry),
+        "index_dropped": m["index_dropped"],
+        "pending": len(_write_buffer),
+        "batch_size": _summary(m["batch_sizes"]),
+        "flush_ms": _summary(m["flush_ms"]),
+    }
+
+# ----------------------------- Mantenimiento
+@app.post("/mantenimiento/compactar")
+def mantenimiento_compactar(
+    request: Request,
+    dias: Optional[int] = Query(None, ge=1, description="Archivar pedidos cerrados con más de N días (por defecto ARCHIVE_AFTER_DAYS)"),
+    limite: int = Query(2000, ge=1, le=5000, description="Máximo de documentos a leer por fase"),
+    completo: bool = Query(False, description="Ignorar la marca de agua y re-escanear todo"),
+    dry_run: bool = Query(False, description="Solo contar, sin borrar ni archivar"),
+):
+    _check_admin(request)
+    db, bucket = _db_bucket()
+    now = datetime.datetime.utcnow()
+
+    dd_window = max(int(os.getenv("WA_DEDUP_WINDOW_SECS", "900")), 0)
+    pruned = _prune_notifications(db, now - datetime.timedelta(seconds=dd_window), limite, dry_run=dry_run)
+
+    age_days = dias or int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+    closed_cfg = os.getenv("ARCHIVE_CLOSED_STATUSES", "completed,cancelled,refunded,failed")
+    closed_statuses = {s.strip().lower() for s in closed_cfg.split(",") if s.strip()}
+    result = _archive_closed_orders(
+        db, bucket, now - datetime.timedelta(days=age_days), limite,
+        closed_statuses, full_scan=completo, dry_run=dry_run,
+    )
+    logger.info(f"COMPACTACION: notifications={pruned} pedidos={result['archived']} meses={result['months']} dry_run={dry_run}")
+
+    return {
+        "ok": True,
+        "dry_run": dry_run,
+        "notifications_pruned": pruned,
+        "pedidos_archived": result["archived"],
+        "pedidos_scanned": result["scanned"],
+        "pedidos_rechecked": result["rechecked"],
+        "pedidos_skipped_changed": result["skipped_changed"],
+        "pedidos_open_tracked": result["open_tracked"],
+        "months": result["months"],
+        "complete": result["complete"],
+    }
@@ -0,0 +1,232 @@
+# campana_whatsapp.py
+"""
+Envío masivo de la plantilla `pedido_confirmado` con whatsapp.send_template.
+
+Ejemplos:
+    python campana_whatsapp.py --csv pendientes.csv --campana backlog-octubre
+    python campana_whatsapp.py --desde 2024-10-01 --hasta 2024-10-15 --campana backlog --tier 10k
+
+El CSV lleva columnas to, order_id, name, total. El progreso se guarda en un
+archivo JSONL (una línea por cambio de estado, con fsync); si el proceso se
+cae, re-ejecutar con la misma --campana retoma sin reenviar lo ya enviado.
+Un destinatario que quedó "sending" sin respuesta, o cuya petición se cortó
+después de enviada (timeout de lectura, conexión reseteada), se considera
+incierto y no se reenvía salvo que se pida --reintentar-inciertos.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+import whatsapp
+from angela_server import _db_bucket, _normalize_phone, _fmt_currency
+
+# Límite de destinatarios únicos por 24h según el tier de mensajería de Meta.
+TIER_DAILY_LIMITS = {"250": 250, "1k": 1_000, "10k": 10_000, "100k": 100_000, "unlimited": None}
+# Throughput por defecto de Cloud API por número (mensajes/segundo).
+DEFAULT_RATE = 80.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# ----------------------------- Limitador
+class TokenBucket:
+    """Token bucket thread-safe: `rate` tokens/s con ráfagas de hasta `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# ----------------------------- Progreso
+class Progress:
+    """Bitácora append-only del estado de cada destinatario."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            continue  # última línea truncada por una caída
+                        self.state[rec["key"]] = rec
+        self.f = open(path, "a", encoding="utf-8")
+
+    def record(self, key: str, state: str, **extra):
+        rec = {"key": key, "state": state, "ts": datetime.datetime.utcnow().isoformat(), **extra}
+        line = json.dumps(rec, ensure_ascii=False)
+        with self.lock:
+            self.f.write(line + "\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.state[key] = rec
+
+    def sent_last_24h(self) -> set:
+        since = (datetime.datetime.utcnow() - datetime.timedelta(hours=24)).isoformat()
+        return {r.get("to") for r in self.state.values() if r["state"] == "sent" and r["ts"] >= since}
+
+    def close(self):
+        self.f.close()
+
+# ----------------------------- Fuentes
+def _rows_from_csv(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        return [
+            {"to": r.get("to", ""), "order_id": r.get("order_id", ""), "name": r.get("name", ""), "total": r.get("total", "")}
+            for r in csv.DictReader(f)
+        ]
+
+def _rows_from_firestore(desde: str, hasta: str) -> List[Dict[str, Any]]:
+    """Pedidos de compra (paid_like) creados en el rango."""
+    db, _ = _db_bucket()
+    start = datetime.datetime.fromisoformat(desde)
+    end = datetime.datetime.fromisoformat(hasta) + datetime.timedelta(days=1)
+    q = (db.collection("Pedidos")
+         .where("created_at", ">=", start).where("created_at", "<", end)
+         .where("paid_like", "==", True)
+         .select(["order_id", "order_number", "total", "customer.name", "customer.phone"]))
+    rows = []
+    for snap in q.stream():
+        d = snap.to_dict() or {}
+        customer = d.get("customer") or {}
+        rows.append({
+            "to": customer.get("phone") or "",
+            "order_id": d.get("order_number") or d.get("order_id") or snap.id,
+            "name": customer.get("name") or "",
+            "total": _fmt_currency(float(d.get("total") or 0.0)),
+        })
+    return rows
+
+# ----------------------------- Envío
+def _not_sent(e: requests.RequestException) -> bool:
+    """True si la petición falló antes de llegar a Graph (no pudo conectar)."""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError):
+        reason = getattr(e.args[0] if e.args else None, "reason", None)
+        return isinstance(reason, NewConnectionError)
+    return False
+
+def _send_one(row: Dict[str, Any], key: str, args, bucket: TokenBucket, progress: Progress) -> str:
+    progress.record(key, "sending", to=row["to"], order_id=row["order_id"])
+    attempt = 0
+    while True:
+        attempt += 1
+        bucket.acquire()
+        try:
+            resp = whatsapp.send_template(row["to"], row["order_id"], row["name"], row["total"],
+                                          template_name=args.plantilla, language=args.idioma)
+            msg_id = ((resp or {}).get("messages") or [{}])[0].get("id")
+            progress.record(key, "sent", to=row["to"], order_id=row["order_id"], message_id=msg_id)
+            return "sent"
+        except requests.RequestException as e:
+            code = getattr(getattr(e, "response", None), "status_code", None)
+            if code is None and not _not_sent(e):
+                # Graph pudo haber aceptado el mensaje: no se reintenta
+                progress.record(key, "uncertain", to=row["to"], order_id=row["order_id"], error=str(e)[:300])
+                return "uncertain"
+            if (code is None or code in RETRY_STATUS) and attempt < args.reintentos:
+                time.sleep(min(30.0, 2 ** attempt))
+                continue
+            progress.record(key, "failed", to=row["to"], order_id=row["order_id"],
+                            status_code=code, error=str(e)[:300])
+            return "failed"
+
+def run(rows: List[Dict[str, Any]], args) -> Dict[str, Any]:
+    progress = Progress(args.progreso or f"campana_{args.campana}.jsonl")
+    bucket = TokenBucket(args.rate)
+    daily_cap = TIER_DAILY_LIMITS[args.tier]
+    recipients = progress.sent_last_24h()
+
+    todo = []
+    queued: set = set()
+    stats = {"total": len(rows), "sent": 0, "failed": 0, "already_sent": 0,
+             "uncertain": 0, "invalid": 0, "over_tier": 0}
+    for row in rows:
+        row = dict(row, to=_normalize_phone(row.get("to")))
+        if not (row["to"] and row.get("order_id")):
+            stats["invalid"] += 1
+            continue
+        key = f"{args.plantilla}:{row['to']}:{row['order_id']}"
+        prev = (progress.state.get(key) or {}).get("state")
+        if prev == "sent" or key in queued:
+            stats["already_sent"] += 1
+            continue
+        if prev in ("sending", "uncertain") and not args.reintentar_inciertos:
+            stats["uncertain"] += 1
+            continue
+        if daily_cap is not None and row["to"] not in recipients and len(recipients) >= daily_cap:
+            stats["over_tier"] += 1
+            continue
+        recipients.add(row["to"])
+        queued.add(key)
+        todo.append((row, key))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        for state in pool.map(lambda rk: _send_one(rk[0], rk[1], args, bucket, progress), todo):
+            stats[state] += 1
+    progress.close()
+
+    elapsed = time.monotonic() - start
+    stats["elapsed_s"] = round(elapsed, 1)
+    stats["msgs_per_s"] = round(stats["sent"] / elapsed, 2) if elapsed > 0 else 0.0
+    return stats
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Campaña masiva de plantilla WhatsApp")
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument("--csv", help="CSV con columnas to, order_id, name, total")
+    src.add_argument("--desde", help="Leer Pedidos pagados desde esta fecha (YYYY-MM-DD)")
+    p.add_argument("--hasta", default=datetime.date.today().isoformat(), help="Fin del rango con --desde")
+    p.add_argument("--campana", required=True, help="Nombre de la campaña (define el archivo de progreso)")
+    p.add_argument("--progreso", help="Ruta del JSONL de progreso (por defecto campana_<nombre>.jsonl)")
+    p.add_argument("--plantilla", default="pedido_confirmado")
+    p.add_argument("--idioma", default="es_CO")
+    p.add_argument("--rate", type=float, default=DEFAULT_RATE, help="Mensajes por segundo")
+    p.add_argument("--tier", choices=list(TIER_DAILY_LIMITS), default="1k",
+                   help="Tier de mensajería: tope de destinatarios únicos por 24h")
+    p.add_argument("--concurrencia", type=int, default=16)
+    p.add_argument("--reintentos", type=int, default=4, help="Intentos ante 429/5xx/errores de red")
+    p.add_argument("--reintentar-inciertos", action="store_true",
+                   help="Reenviar destinatarios en estado incierto (puede duplicar)")
+    args = p.parse_args(argv)
+
+    if args.rate <= 0 or args.concurrencia < 1:
+        p.error("--rate y --concurrencia deben ser positivos")
+    if not (whatsapp.WA_TOKEN and whatsapp.WA_PHONE_ID):
+        p.error("faltan WHATSAPP_TOKEN / WHATSAPP_PHONE_ID")
+
+    rows = _rows_from_csv(args.csv) if args.csv else _rows_from_firestore(args.desde, args.hasta)
+    stats = run(rows, args)
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+    return 1 if stats["failed"] or stats["uncertain"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
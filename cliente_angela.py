@@ -1,24 +1,268 @@
 # cliente_angela.py
+"""
+Generador de carga para Angela Memoria API.
+
+Ejemplos:
+    python cliente_angela.py --rate 50 --concurrency 20 --duration 60 --corpus capturas/
+    python cliente_angela.py --mix webhook=1 --requests 500 --dup-rate 0.2
+
+Las peticiones se programan a ritmo fijo (lazo abierto): la latencia se mide
+desde el instante programado, así que la espera en cola cuenta y un servidor
+saturado no "esconde" su lentitud.
+
+⚠️  Apunta a un entorno de pruebas: el webhook puede enviar WhatsApp y tocar Woo.
+"""
 import os
-import requests
+import sys
+import math
+import json
+import time
+import hmac
+import glob
+import base64
+import random
+import asyncio
+import hashlib
+import argparse
+import datetime
+from typing import Optional, List, Dict, Any, Tuple
+
+import httpx
 
 API_URL = os.getenv("ANGELA_API_URL", "http://127.0.0.1:8000")
+ENDPOINTS = ("memoria", "archivo", "reporte", "webhook")
+
+# ----------------------------- Corpus Woo
+def _load_corpus(path: Optional[str]) -> List[Dict[str, Any]]:
+    """Lee payloads capturados: un directorio de *.json o un archivo .json/.ndjson."""
+    if not path:
+        return []
+    files = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+    corpus: List[Dict[str, Any]] = []
+    for fn in files:
+        with open(fn, "r", encoding="utf-8") as f:
+            text = f.read()
+        if fn.endswith(".ndjson"):
+            corpus.extend(json.loads(line) for line in text.splitlines() if line.strip())
+        else:
+            data = json.loads(text)
+            corpus.extend(data if isinstance(data, list) else [data])
+    return corpus
+
+def _synthetic_order(order_id: int) -> Dict[str, Any]:
+    now = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
+    return {
+        "id": order_id,
+        "number": str(order_id),
+        "status": "processing",
+        "currency": "COP",
+        "total": "129900",
+        "date_created": now,
+        "payment_method_title": "Carga",
+        "billing": {
+            "first_name": "Cliente",
+            "last_name": f"Carga {order_id}",
+            "phone": f"300{order_id % 10_000_000:07d}",
+            "email": f"carga{order_id}@example.com",
+            "city": "Medellín",
+        },
+        "line_items": [{"name": "Producto carga", "sku": "LOAD-1", "quantity": 1,
+                        "price": "129900", "subtotal": "129900", "total": "129900"}],
+    }
+
+def _sign(secret: str, raw: bytes) -> str:
+    # mismo cálculo que angela_server.webhook_woocommerce
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), raw, hashlib.sha256).digest()).decode()
+
+# ----------------------------- Peticiones
+class Generator:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.corpus = _load_corpus(args.corpus)
+        self.secret = args.secret
+        self.next_id = args.id_base
+        self.archivo: Tuple[str, bytes]
+        if args.archivo and os.path.exists(args.archivo):
+            with open(args.archivo, "rb") as f:
+                self.archivo = (os.path.basename(args.archivo), f.read())
+        else:
+            self.archivo = ("carga.txt", b"angela carga\n" * 64)
+        weights = _parse_mix(args.mix)
+        self.mix_names = list(weights)
+        self.mix_weights = [weights[k] for k in self.mix_names]
+
+    def pick(self) -> str:
+        return random.choices(self.mix_names, weights=self.mix_weights)[0]
+
+    def webhook_body(self) -> bytes:
+        if self.corpus:
+            payload = dict(random.choice(self.corpus))
+        else:
+            payload = _synthetic_order(self.next_id)
+        if self.args.unique_ids or not self.corpus:
+            payload["id"] = self.next_id
+            payload["number"] = str(self.next_id)
+            self.next_id += 1
+        return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+    async def send(self, client: httpx.AsyncClient, kind: str, body: Optional[bytes] = None) -> int:
+        if kind == "memoria":
+            r = await client.post("/guardar_memoria", data={"texto": "Angela prueba de carga", "etiqueta": "carga"})
+        elif kind == "archivo":
+            name, data = self.archivo
+            r = await client.post("/subir_archivo", files={"file": (f"carga/{int(time.time() * 1000)}_{name}", data)})
+        elif kind == "reporte":
+            r = await client.get("/reportes/ventas", params={"desde": self.args.desde, "hasta": self.args.hasta})
+        else:
+            headers = {"Content-Type": "application/json"}
+            if self.secret:
+                headers["X-WC-Webhook-Signature"] = _sign(self.secret, body or b"")
+            r = await client.post("/webhook/woocommerce", content=body, headers=headers)
+        return r.status_code
+
+def _parse_mix(spec: str) -> Dict[str, float]:
+    weights: Dict[str, float] = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, w = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Endpoint desconocido en --mix: {name} (usa {', '.join(ENDPOINTS)})")
+        weights[name] = float(w or 1)
+    if not weights or sum(weights.values()) <= 0:
+        raise SystemExit("--mix no tiene pesos positivos")
+    return weights
+
+# ----------------------------- Métricas
+def _percentile(sorted_vals: List[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    # nearest-rank
+    idx = max(0, math.ceil(p / 100 * len(sorted_vals)) - 1)
+    return sorted_vals[idx]
+
+class Stats:
+    def __init__(self):
+        self.lat: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.codes: Dict[str, Dict[str, int]] = {}
+
+    def record(self, kind: str, latency: float, code: str, ok: bool):
+        self.lat.setdefault(kind, []).append(latency)
+        self.codes.setdefault(kind, {})
+        self.codes[kind][code] = self.codes[kind].get(code, 0) + 1
+        if not ok:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed: float):
+        print(f"\n⏱  {elapsed:.1f}s")
+        header = f"{'endpoint':<18}{'n':>7}{'req/s':>9}{'err%':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  códigos"
+        print(header)
+        print("-" * len(header))
+        all_lat: List[float] = []
+        all_err = 0
+        for kind in sorted(self.lat):
+            vals = sorted(self.lat[kind])
+            all_lat.extend(vals)
+            err = self.errors.get(kind, 0)
+            all_err += err
+            self._row(kind, vals, err, elapsed, self.codes.get(kind, {}))
+        self._row("TOTAL", sorted(all_lat), all_err, elapsed, {})
+
+    @staticmethod
+    def _row(kind: str, vals: List[float], err: int, elapsed: float, codes: Dict[str, int]):
+        n = len(vals)
+        codes_str = " ".join(f"{c}:{k}" for c, k in sorted(codes.items()))
+        print(
+            f"{kind:<18}{n:>7}{(n / elapsed if elapsed else 0):>9.1f}{(100 * err / n if n else 0):>8.2f}"
+            f"{_percentile(vals, 50) * 1000:>10.1f}{_percentile(vals, 95) * 1000:>10.1f}"
+            f"{_percentile(vals, 99) * 1000:>10.1f}  {codes_str}"
+        )
+
+# ----------------------------- Bucle principal
+async def _worker(gen: Generator, client: httpx.AsyncClient, queue: asyncio.Queue, stats: Stats):
+    while True:
+        job = await queue.get()
+        if job is None:
+            queue.task_done()
+            return
+        scheduled, kind, label, body = job
+        try:
+            code = await gen.send(client, kind, body)
+            stats.record(label, time.perf_counter() - scheduled, str(code), code < 400)
+        except httpx.HTTPError as e:
+            stats.record(label, time.perf_counter() - scheduled, type(e).__name__, False)
+        finally:
+            queue.task_done()
+
+async def run(args: argparse.Namespace) -> Stats:
+    gen = Generator(args)
+    stats = Stats()
+    # sin --rate el lazo es cerrado: la cola acotada frena al productor
+    queue: asyncio.Queue = asyncio.Queue(maxsize=args.concurrency if args.rate <= 0 else 0)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        workers = [asyncio.create_task(_worker(gen, client, queue, stats)) for _ in range(args.concurrency)]
+        interval = 1.0 / args.rate if args.rate > 0 else 0.0
+        start = time.perf_counter()
+        deadline = start + args.duration if args.duration else None
+        sent = 0
+        while (not args.requests or sent < args.requests) and (deadline is None or time.perf_counter() < deadline):
+            kind = gen.pick()
+            body = gen.webhook_body() if kind == "webhook" else None
+            if interval:
+                scheduled = start + sent * interval
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+            await queue.put((scheduled, kind, kind, body))
+            if kind == "webhook" and random.random() < args.dup_rate:
+                # re-entrega: mismos bytes y misma firma, como hace Woo al reintentar
+                await queue.put((scheduled, kind, "webhook(dup)", body))
+            sent += 1
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        stats.report(time.perf_counter() - start)
+    return stats
 
-print(f"🤖 Cliente Angela apuntando a: {API_URL}")
+def main(argv: Optional[List[str]] = None) -> int:
+    today = datetime.date.today()
+    p = argparse.ArgumentParser(description="Prueba de carga para Angela Memoria API")
+    p.add_argument("--url", default=API_URL, help="URL base (ANGELA_API_URL)")
+    p.add_argument("--concurrency", type=int, default=10, help="Peticiones simultáneas máximas")
+    p.add_argument("--rate", type=float, default=10.0, help="Peticiones por segundo (0 = sin límite)")
+    p.add_argument("--duration", type=float, default=None,
+                   help="Segundos de prueba (por defecto 30; sin límite de tiempo si se da --requests)")
+    p.add_argument("--requests", type=int, default=0, help="Total de peticiones (0 = hasta --duration)")
+    p.add_argument("--mix", default="webhook=6,memoria=2,archivo=1,reporte=1",
+                   help=f"Pesos por endpoint ({', '.join(ENDPOINTS)})")
+    p.add_argument("--corpus", help="Directorio de *.json o archivo .json/.ndjson con payloads Woo capturados")
+    p.add_argument("--secret", default=os.getenv("WC_WEBHOOK_SECRET", ""), help="Secreto HMAC (WC_WEBHOOK_SECRET)")
+    p.add_argument("--dup-rate", type=float, default=0.1, help="Probabilidad de re-entregar un webhook duplicado")
+    p.add_argument("--unique-ids", action="store_true", help="Reescribe id/number del corpus para que cada envío sea un pedido nuevo")
+    p.add_argument("--id-base", type=int, default=int(time.time()) % 1_000_000_000, help="Primer id sintético")
+    p.add_argument("--archivo", default="ejemplo.xlsx", help="Archivo para /subir_archivo (si no existe se genera uno)")
+    p.add_argument("--desde", default=(today - datetime.timedelta(days=7)).isoformat(), help="Rango de /reportes/ventas")
+    p.add_argument("--hasta", default=today.isoformat(), help="Rango de /reportes/ventas")
+    p.add_argument("--timeout", type=float, default=30.0, help="Timeout por petición (s)")
+    args = p.parse_args(argv)
 
-# Probar guardar memoria
-resp = requests.post(f"{API_URL}/guardar_memoria",
-                     data={"texto": "Angela recuerda mi primera prueba", "etiqueta": "demo"})
-print("📌 Respuesta memoria:", resp.json())
+    if args.concurrency < 1:
+        p.error("--concurrency debe ser >= 1")
+    if args.duration is None:
+        args.duration = 0.0 if args.requests else 30.0
+    if not args.duration and not args.requests:
+        p.error("indica --duration o --requests")
 
-# Probar guardar estado
-resp = requests.post(f"{API_URL}/guardar_estado", data={"estado": "Activo"})
-print("📌 Respuesta estado:", resp.json())
+    print(f"🤖 Cliente Angela apuntando a: {args.url}")
+    print(f"   concurrencia={args.concurrency} rate={args.rate or '∞'}/s mix={args.mix} "
+          f"firma={'sí' if args.secret else 'no'} dup={args.dup_rate}")
+    stats = asyncio.run(run(args))
+    return 1 if sum(stats.errors.values()) else 0
 
-# Probar subir archivo (asegúrate de tener 'ejemplo.xlsx' en la misma carpeta)
-try:
-    with open("ejemplo.xlsx", "rb") as f:
-        resp = requests.post(f"{API_URL}/subir_archivo", files={"file": f})
-    print("📌 Respuesta archivo:", resp.json())
-except FileNotFoundError:
-    print("⚠️  No se encontró 'ejemplo.xlsx'. Omite esta prueba o coloca un archivo con ese nombre.")
+if __name__ == "__main__":
+    sys.exit(main())